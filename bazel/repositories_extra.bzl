@@ -59,6 +59,17 @@ def _python_deps():
         # release_date = "2019-02-23"
         # use_category = ["test"],
     )
+    pip_install(
+        name = "extensions_pip3",
+        requirements = "@envoy//tools/extensions:requirements.txt",
+        extra_pip_args = ["--require-hashes"],
+
+        # project_name = "orjson",
+        # project_url = "https://github.com/ijl/orjson",
+        # version = "3.5.2",
+        # release_date = "2021-04-15"
+        # use_category = ["docs"],
+    )
     pip_install(
         name = "headersplit_pip3",
         requirements = "@envoy//tools/envoy_headersplit:requirements.txt",
@@ -11,13 +11,15 @@
 # `EXTENSION_DB_PATH`
 
 import ast
-import json
+import hashlib
+import itertools
 import os
 import pathlib
-import re
 import subprocess
 import sys
 
+import orjson
+
 from importlib.util import spec_from_loader, module_from_spec
 from importlib.machinery import SourceFileLoader
 
@@ -26,36 +28,38 @@ BUILDOZER_PATH = os.path.abspath(
 
 ENVOY_SRCDIR = os.getenv('ENVOY_SRCDIR', '/source')
 
-if not os.path.exists(ENVOY_SRCDIR):
-    raise SystemExit(
-        "Envoy source must either be located at /source, or ENVOY_SRCDIR env var must be set")
-
-# source/extensions/extensions_build_config.bzl must have a .bzl suffix for Starlark
-# import, so we are forced to do this workaround.
-_extensions_build_config_spec = spec_from_loader(
-    'extensions_build_config',
-    SourceFileLoader(
-        'extensions_build_config',
-        os.path.join(ENVOY_SRCDIR, 'source/extensions/extensions_build_config.bzl')))
-extensions_build_config = module_from_spec(_extensions_build_config_spec)
-_extensions_build_config_spec.loader.exec_module(extensions_build_config)
-
 
 class ExtensionDbError(Exception):
     pass
 
 
+def load_extensions_build_config():
+    if not os.path.exists(ENVOY_SRCDIR):
+        raise SystemExit(
+            "Envoy source must either be located at /source, or ENVOY_SRCDIR env var must be set")
+    # source/extensions/extensions_build_config.bzl must have a .bzl suffix for Starlark
+    # import, so we are forced to do this workaround.
+    extensions_build_config_spec = spec_from_loader(
+        'extensions_build_config',
+        SourceFileLoader(
+            'extensions_build_config',
+            os.path.join(ENVOY_SRCDIR, 'source/extensions/extensions_build_config.bzl')))
+    extensions_build_config = module_from_spec(extensions_build_config_spec)
+    extensions_build_config_spec.loader.exec_module(extensions_build_config)
+    return extensions_build_config
+
+
 def is_missing(value):
     return value == '(missing)'
 
 
 def num_read_filters_fuzzed():
-    data = pathlib.Path(
-        os.path.join(
-            ENVOY_SRCDIR,
-            'test/extensions/filters/network/common/fuzz/uber_per_readfilter.cc')).read_text()
     # Hack-ish! We only search the first 50 lines to capture the filters in filterNames().
-    return len(re.findall('NetworkFilterNames::get()', ''.join(data.splitlines()[:50])))
+    with open(os.path.join(
+            ENVOY_SRCDIR,
+            'test/extensions/filters/network/common/fuzz/uber_per_readfilter.cc')) as f:
+        head = ''.join(itertools.islice(f, 50))
+    return head.count('NetworkFilterNames::get()')
 
 
 def num_robust_to_downstream_network_filters(db):
@@ -66,16 +70,16 @@ def num_robust_to_downstream_network_filters(db):
     ])
 
 
-def get_extension_metadata(target):
-    if not BUILDOZER_PATH:
-        raise ExtensionDbError('Buildozer not found!')
-    r = subprocess.run(
-        [BUILDOZER_PATH, '-stdout', 'print security_posture status undocumented category', target],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    rout = r.stdout.decode('utf-8').strip().split(' ')
-    security_posture, status, undocumented = rout[:3]
-    categories = ' '.join(rout[3:])
+METADATA_ATTRIBUTES = 'security_posture status undocumented category'
+
+# Bump when parse_extension_metadata() changes, to invalidate cached metadata.
+CACHE_VERSION = 1
+CACHE_SCHEMA = '%d:%s' % (CACHE_VERSION, METADATA_ATTRIBUTES)
+
+
+def parse_extension_metadata(target, fields):
+    security_posture, status, undocumented = fields[:3]
+    categories = ' '.join(fields[3:])
     if is_missing(security_posture):
         raise ExtensionDbError(
             'Missing security posture for %s.  Please make sure the target is an envoy_cc_extension and security_posture is set'
@@ -96,6 +100,90 @@ def get_extension_metadata(target):
     }
 
 
+# Split the output of batched buildozer 'print label ...' commands into a map
+# from label to the printed attribute values. Each record starts with the
+# target's label, but non-string attributes such as multi-line category tuples
+# may be printed over several lines, so any line not starting with a label
+# continues the previous record.
+def parse_buildozer_output(output):
+    rout = {}
+    fields = None
+    for line in output.splitlines():
+        if line.startswith('//'):
+            label, *fields = line.split()
+            rout[label] = fields
+        elif fields is not None:
+            fields.extend(line.split())
+    return rout
+
+
+# Query metadata for all targets with a single buildozer process, returning a
+# map from target to metadata. Each output record is prefixed with the target's
+# label, as buildozer does not guarantee output order matches command order.
+def get_extensions_metadata(targets):
+    if not BUILDOZER_PATH:
+        raise ExtensionDbError('Buildozer not found!')
+    commands = ''.join('print label %s|%s\n' % (METADATA_ATTRIBUTES, target) for target in targets)
+    r = subprocess.run([BUILDOZER_PATH, '-stdout', '-f', '-'],
+                       input=commands,
+                       capture_output=True,
+                       text=True)
+    rout = parse_buildozer_output(r.stdout)
+    metadata = {}
+    for target in targets:
+        if target not in rout:
+            raise ExtensionDbError('No buildozer output for %s' % target)
+        metadata[target] = parse_extension_metadata(target, rout[target])
+    return metadata
+
+
+def build_file_hash(target):
+    package = target[2:].split(':')[0]
+    build_file = pathlib.Path(ENVOY_SRCDIR, package, 'BUILD')
+    return hashlib.sha256(build_file.read_bytes()).hexdigest()
+
+
+# Load the metadata cache, treating a missing or unreadable cache as empty.
+def load_metadata_cache(cache_file):
+    try:
+        cache = orjson.loads(cache_file.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def is_fresh_cache_entry(entry, build_hash):
+    return (
+        isinstance(entry, dict) and entry.get('schema') == CACHE_SCHEMA
+        and entry.get('hash') == build_hash and 'metadata' in entry)
+
+
+# Like get_extensions_metadata, but reuses results stored in cache_path for
+# targets whose BUILD file is unchanged since the cache was written.
+def get_cached_extensions_metadata(targets, cache_path):
+    cache_file = pathlib.Path(cache_path)
+    cache = load_metadata_cache(cache_file)
+    hashes = {target: build_file_hash(target) for target in set(targets)}
+    metadata = {}
+    for target, build_hash in hashes.items():
+        entry = cache.get(target)
+        if is_fresh_cache_entry(entry, build_hash):
+            metadata[target] = entry['metadata']
+    stale_targets = [target for target in hashes if target not in metadata]
+    if stale_targets:
+        metadata.update(get_extensions_metadata(stale_targets))
+    cache_file.write_bytes(
+        orjson.dumps({
+            target: {
+                'schema': CACHE_SCHEMA,
+                'hash': build_hash,
+                'metadata': metadata[target]
+            }
+            for target, build_hash in hashes.items()
+        }))
+    return metadata
+
+
 if __name__ == '__main__':
     try:
         output_path = os.getenv("EXTENSION_DB_PATH") or sys.argv[1]
@@ -103,31 +191,36 @@ if __name__ == '__main__':
         raise SystemExit(
             "Output path must be either specified as arg or with EXTENSION_DB_PATH env var")
 
-    extension_db = {}
+    extensions_build_config = load_extensions_build_config()
     # Include all extensions from source/extensions/extensions_build_config.bzl
     all_extensions = {}
     all_extensions.update(extensions_build_config.EXTENSIONS)
-    for extension, target in all_extensions.items():
-        extension_db[extension] = get_extension_metadata(target)
-    if num_robust_to_downstream_network_filters(extension_db) != num_read_filters_fuzzed():
-        raise ExtensionDbError(
-            'Check that all network filters robust against untrusted'
-            'downstreams are fuzzed by adding them to filterNames() in'
-            'test/extensions/filters/network/common/uber_per_readfilter.cc')
     # The TLS and generic upstream extensions are hard-coded into the build, so
     # not in source/extensions/extensions_build_config.bzl
     # TODO(mattklein123): Read these special keys from all_extensions.bzl or a shared location to
     # avoid duplicate logic.
-    extension_db['envoy.transport_sockets.tls'] = get_extension_metadata(
-        '//source/extensions/transport_sockets/tls:config')
-    extension_db['envoy.upstreams.http.generic'] = get_extension_metadata(
-        '//source/extensions/upstreams/http/generic:config')
-    extension_db['envoy.upstreams.tcp.generic'] = get_extension_metadata(
-        '//source/extensions/upstreams/tcp/generic:config')
-    extension_db['envoy.upstreams.http.http_protocol_options'] = get_extension_metadata(
-        '//source/extensions/upstreams/http:config')
-    extension_db['envoy.request_id.uuid'] = get_extension_metadata(
-        '//source/extensions/request_id/uuid:config')
+    builtin_extensions = {
+        'envoy.transport_sockets.tls': '//source/extensions/transport_sockets/tls:config',
+        'envoy.upstreams.http.generic': '//source/extensions/upstreams/http/generic:config',
+        'envoy.upstreams.tcp.generic': '//source/extensions/upstreams/tcp/generic:config',
+        'envoy.upstreams.http.http_protocol_options': '//source/extensions/upstreams/http:config',
+        'envoy.request_id.uuid': '//source/extensions/request_id/uuid:config',
+    }
 
     pathlib.Path(os.path.dirname(output_path)).mkdir(parents=True, exist_ok=True)
-    pathlib.Path(output_path).write_text(json.dumps(extension_db))
+    # A single buildozer process handles every target whose BUILD file changed
+    # since the last run, avoiding the per-target process startup and BUILD file
+    # loading cost.
+    metadata = get_cached_extensions_metadata(
+        list(all_extensions.values()) + list(builtin_extensions.values()),
+        os.path.join(os.path.dirname(output_path), '.extension_db_cache.json'))
+    extension_db = {extension: metadata[target] for extension, target in all_extensions.items()}
+    if num_robust_to_downstream_network_filters(extension_db) != num_read_filters_fuzzed():
+        raise ExtensionDbError(
+            'Check that all network filters robust against untrusted'
+            'downstreams are fuzzed by adding them to filterNames() in'
+            'test/extensions/filters/network/common/uber_per_readfilter.cc')
+    for extension, target in builtin_extensions.items():
+        extension_db[extension] = metadata[target]
+
+    pathlib.Path(output_path).write_bytes(orjson.dumps(extension_db))
@@ -0,0 +1,95 @@
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import generate_extension_db
+
+# Output of batched buildozer 'print label ...' commands, where non-string
+# attributes such as category tuples may span multiple lines.
+BUILDOZER_OUTPUT = """//source/extensions/transport_sockets/tls:config robust_to_untrusted_downstream_and_upstream (missing) (missing) (
+    "envoy.transport_sockets.downstream",
+    "envoy.transport_sockets.upstream",
+)
+//source/extensions/filters/http/router:config robust_to_untrusted_downstream stable (missing) envoy.filters.http.upstream
+//source/extensions/filters/network/echo:config unknown alpha True ["envoy.filters.network"]
+"""
+
+
+class GenerateExtensionDbTest(unittest.TestCase):
+
+    def test_parse_buildozer_output(self):
+        """parse_buildozer_output groups multi-line records by label."""
+        rout = generate_extension_db.parse_buildozer_output(BUILDOZER_OUTPUT)
+        self.assertEqual(
+            sorted(rout.keys()), [
+                '//source/extensions/filters/http/router:config',
+                '//source/extensions/filters/network/echo:config',
+                '//source/extensions/transport_sockets/tls:config',
+            ])
+        self.assertEqual(
+            rout['//source/extensions/filters/http/router:config'], [
+                'robust_to_untrusted_downstream', 'stable', '(missing)',
+                'envoy.filters.http.upstream'
+            ])
+
+    def test_parse_extension_metadata(self):
+        """parse_extension_metadata handles single and multi-line categories."""
+        rout = generate_extension_db.parse_buildozer_output(BUILDOZER_OUTPUT)
+        target = '//source/extensions/transport_sockets/tls:config'
+        self.assertEqual(
+            generate_extension_db.parse_extension_metadata(target, rout[target]), {
+                'security_posture':
+                    'robust_to_untrusted_downstream_and_upstream',
+                'undocumented':
+                    False,
+                'status':
+                    'stable',
+                'categories':
+                    ('envoy.transport_sockets.downstream', 'envoy.transport_sockets.upstream'),
+            })
+        target = '//source/extensions/filters/http/router:config'
+        self.assertEqual(
+            generate_extension_db.parse_extension_metadata(target, rout[target])['categories'],
+            ['envoy.filters.http.upstream'])
+        target = '//source/extensions/filters/network/echo:config'
+        self.assertEqual(
+            generate_extension_db.parse_extension_metadata(target, rout[target]), {
+                'security_posture': 'unknown',
+                'undocumented': True,
+                'status': 'alpha',
+                'categories': ['envoy.filters.network'],
+            })
+
+    def test_get_cached_extensions_metadata(self):
+        """get_cached_extensions_metadata only reuses valid, current cache entries."""
+        target = '//source/extensions/foo:config'
+        with tempfile.TemporaryDirectory() as src_dir, \
+                mock.patch.object(generate_extension_db, 'ENVOY_SRCDIR', src_dir), \
+                mock.patch.object(generate_extension_db, 'get_extensions_metadata') as get_metadata:
+            get_metadata.side_effect = lambda targets: {t: {'status': 'stable'} for t in targets}
+            build_file = pathlib.Path(src_dir, 'source/extensions/foo/BUILD')
+            build_file.parent.mkdir(parents=True)
+            build_file.write_text('envoy_cc_extension()')
+            cache_path = os.path.join(src_dir, 'cache.json')
+            # A corrupt cache is a miss.
+            pathlib.Path(cache_path).write_text('{"trunc')
+            metadata = generate_extension_db.get_cached_extensions_metadata([target], cache_path)
+            self.assertEqual(metadata[target]['status'], 'stable')
+            self.assertEqual(get_metadata.call_count, 1)
+            # An unchanged BUILD file is a hit.
+            generate_extension_db.get_cached_extensions_metadata([target], cache_path)
+            self.assertEqual(get_metadata.call_count, 1)
+            # A changed BUILD file is a miss.
+            build_file.write_text('envoy_cc_extension(name = "config")')
+            generate_extension_db.get_cached_extensions_metadata([target], cache_path)
+            self.assertEqual(get_metadata.call_count, 2)
+            # A change in cache schema is a miss.
+            with mock.patch.object(generate_extension_db, 'CACHE_SCHEMA', 'other'):
+                generate_extension_db.get_cached_extensions_metadata([target], cache_path)
+            self.assertEqual(get_metadata.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
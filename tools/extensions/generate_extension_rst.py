@@ -3,11 +3,12 @@
 # Generate RST lists of extensions grouped by their security posture.
 
 from collections import defaultdict
-import json
 import os
 import pathlib
 import subprocess
 
+import orjson
+
 
 def format_item(extension, metadata):
     if metadata['undocumented']:
@@ -34,7 +35,7 @@ if __name__ == '__main__':
             "Path to a json extension db must be specified with EXTENSION_DB_PATH env var")
     if not os.path.exists(extension_db_path):
         subprocess.run("tools/extensions/generate_extension_db".split(), check=True)
-    extension_db = json.loads(pathlib.Path(extension_db_path).read_text())
+    extension_db = orjson.loads(pathlib.Path(extension_db_path).read_bytes())
 
     pathlib.Path(security_rst_root).mkdir(parents=True, exist_ok=True)
 
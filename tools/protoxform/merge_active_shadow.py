@@ -4,8 +4,6 @@
 # 2. Recovering deprecated (sub)message types.
 # 3. Misc. fixups for oneof metadata and reserved ranges/names.
 
-from collections import defaultdict
-import copy
 import pathlib
 import sys
 
@@ -20,6 +18,9 @@ PROTO_PACKAGES = (
     "envoy.annotations.resource", "udpa.annotations.migrate", "udpa.annotations.security",
     "udpa.annotations.status", "udpa.annotations.sensitive", "udpa.annotations.versioning")
 
+# Prefix given to deprecated fields and enum values in the shadow.
+HIDDEN_PREFIX = 'hidden_envoy_deprecated_'
+
 
 # Set reserved_range in target_proto to reflect previous_reserved_range skipping
 # skip_reserved_numbers.
@@ -32,19 +33,42 @@ def adjust_reserved_range(target_proto, previous_reserved_range, skip_reserved_n
             target_proto.reserved_range.add().MergeFrom(rr)
 
 
+class Dependencies(object):
+    """Wrapper for a file's dependency list with fast membership checks."""
+
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+        self._dependency_set = set(dependencies)
+
+    def add(self, dependency):
+        if dependency not in self._dependency_set:
+            self._dependency_set.add(dependency)
+            self.dependencies.append(dependency)
+
+
 # Add dependencies for envoy.annotations.disallowed_by_default
 def add_deprecation_dependencies(target_proto_dependencies, proto_field, is_enum):
     if is_enum:
-        if proto_field.options.HasExtension(deprecation_pb2.disallowed_by_default_enum) and \
-            "envoy/annotations/deprecation.proto" not in target_proto_dependencies:
-            target_proto_dependencies.append("envoy/annotations/deprecation.proto")
+        if proto_field.options.HasExtension(deprecation_pb2.disallowed_by_default_enum):
+            target_proto_dependencies.add("envoy/annotations/deprecation.proto")
     else:
-        if proto_field.options.HasExtension(deprecation_pb2.disallowed_by_default) and \
-            "envoy/annotations/deprecation.proto" not in target_proto_dependencies:
-            target_proto_dependencies.append("envoy/annotations/deprecation.proto")
-        if proto_field.type_name == ".google.protobuf.Struct" and \
-            "google/protobuf/struct.proto" not in target_proto_dependencies:
-            target_proto_dependencies.append("google/protobuf/struct.proto")
+        if proto_field.options.HasExtension(deprecation_pb2.disallowed_by_default):
+            target_proto_dependencies.add("envoy/annotations/deprecation.proto")
+        if proto_field.type_name == ".google.protobuf.Struct":
+            target_proto_dependencies.add("google/protobuf/struct.proto")
+
+
+# Map from original name to shadow field or enum value, for the deprecated
+# fields or enum values in shadow_items. Only names in reserved_names can be
+# recovered, so when either is empty (the common case) there is nothing to map.
+def hidden_shadow_items(reserved_names, shadow_items):
+    if not reserved_names or not shadow_items:
+        return {}
+    return {
+        item.name[len(HIDDEN_PREFIX):]: item
+        for item in shadow_items
+        if item.name.startswith(HIDDEN_PREFIX)
+    }
 
 
 # Merge active/shadow EnumDescriptorProtos to a fresh target EnumDescriptorProto.
@@ -52,15 +76,19 @@ def merge_active_shadow_enum(active_proto, shadow_proto, target_proto, target_pr
     target_proto.MergeFrom(active_proto)
     if not shadow_proto:
         return
-    shadow_values = {v.name: v for v in shadow_proto.value}
+    hidden_shadow_values = hidden_shadow_items(active_proto.reserved_name, shadow_proto.value)
+    # Nothing to do if no values are recovered from the shadow and there is no
+    # deprecated default value to fix up.
+    if not any(n in hidden_shadow_values for n in active_proto.reserved_name) and not any(
+            v.name == 'DEPRECATED_AND_UNAVAILABLE_DO_NOT_USE' for v in active_proto.value):
+        return
     skip_reserved_numbers = []
     # For every reserved name, check to see if it's in the shadow, and if so,
     # reintroduce in target_proto.
     del target_proto.reserved_name[:]
     for n in active_proto.reserved_name:
-        hidden_n = 'hidden_envoy_deprecated_' + n
-        if hidden_n in shadow_values:
-            v = shadow_values[hidden_n]
+        if n in hidden_shadow_values:
+            v = hidden_shadow_values[n]
             add_deprecation_dependencies(target_proto_dependencies, v, True)
             skip_reserved_numbers.append(v.number)
             target_proto.value.add().MergeFrom(v)
@@ -76,18 +104,28 @@ def merge_active_shadow_enum(active_proto, shadow_proto, target_proto, target_pr
                     tv.CopyFrom(sv)
 
 
-# Adjust source code info comments path to reflect insertions of oneof fields
-# inside the middle of an existing collection of fields.
-def adjust_source_code_info(type_context, field_index, field_adjustment):
+# Return the source code info locations for fields (and their descendants) of
+# the message at type_context.
+def field_locations(type_context):
 
     def has_path_prefix(s, t):
         return len(s) <= len(t) and all(p[0] == p[1] for p in zip(s, t))
 
-    for loc in type_context.source_code_info.proto.location:
-        if has_path_prefix(type_context.path + [2], loc.path):
-            path_field_index = len(type_context.path) + 1
-            if path_field_index < len(loc.path) and loc.path[path_field_index] >= field_index:
-                loc.path[path_field_index] += field_adjustment
+    fields_path = type_context.path + [2]
+    return [
+        loc for loc in type_context.source_code_info.proto.location
+        if has_path_prefix(fields_path, loc.path)
+    ]
+
+
+# Adjust source code info comments path to reflect insertions of oneof fields
+# inside the middle of an existing collection of fields. locations are the
+# message's field locations, as returned by field_locations().
+def adjust_source_code_info(type_context, locations, field_index, field_adjustment):
+    path_field_index = len(type_context.path) + 1
+    for loc in locations:
+        if path_field_index < len(loc.path) and loc.path[path_field_index] >= field_index:
+            loc.path[path_field_index] += field_adjustment
 
 
 # Merge active/shadow DescriptorProtos to a fresh target DescriptorProto.
@@ -96,7 +134,14 @@ def merge_active_shadow_message(
     target_proto.MergeFrom(active_proto)
     if not shadow_proto:
         return
-    shadow_fields = {f.name: f for f in shadow_proto.field}
+    hidden_shadow_fields = hidden_shadow_items(active_proto.reserved_name, shadow_proto.field)
+    shadow_msgs = {msg.name: msg for msg in shadow_proto.nested_type}
+    shadow_enums = {enum.name: enum for enum in shadow_proto.enum_type}
+    # Nothing to do if no fields are recovered from the shadow and there are no
+    # shadow nested types to merge or recover.
+    if not shadow_msgs and not shadow_enums and not any(n in hidden_shadow_fields
+                                                        for n in active_proto.reserved_name):
+        return
     skip_reserved_numbers = []
     # For every reserved name, check to see if it's in the shadow, and if so,
     # reintroduce in target_proto. We track both the normal fields we need to add
@@ -104,64 +149,67 @@ def merge_active_shadow_message(
     # (extra_oneof_fields). The latter require special treatment, as we can't just
     # append them to the end of the message, they need to be reordered.
     extra_simple_fields = []
-    extra_oneof_fields = defaultdict(list)  # oneof index -> list of fields
+    extra_oneof_fields = [[] for _ in target_proto.oneof_decl]  # oneof index -> list of fields
+    oneof_name_to_index = {
+        oneof_decl.name: oneof_index
+        for oneof_index, oneof_decl in enumerate(target_proto.oneof_decl)
+    }
     del target_proto.reserved_name[:]
     for n in active_proto.reserved_name:
-        hidden_n = 'hidden_envoy_deprecated_' + n
-        if hidden_n in shadow_fields:
-            f = shadow_fields[hidden_n]
+        if n in hidden_shadow_fields:
+            f = hidden_shadow_fields[n]
             add_deprecation_dependencies(target_proto_dependencies, f, False)
             skip_reserved_numbers.append(f.number)
-            missing_field = copy.deepcopy(f)
+            missing_field = descriptor_pb2.FieldDescriptorProto()
+            missing_field.CopyFrom(f)
             # oneof fields from the shadow need to have their index set to the
             # corresponding index in active/target_proto.
             if missing_field.HasField('oneof_index'):
                 oneof_name = shadow_proto.oneof_decl[missing_field.oneof_index].name
-                missing_oneof_index = None
-                for oneof_index, oneof_decl in enumerate(target_proto.oneof_decl):
-                    if oneof_decl.name == oneof_name:
-                        missing_oneof_index = oneof_index
+                missing_oneof_index = oneof_name_to_index.get(oneof_name)
                 if missing_oneof_index is None:
                     missing_oneof_index = len(target_proto.oneof_decl)
+                    oneof_name_to_index[oneof_name] = missing_oneof_index
                     target_proto.oneof_decl.add().MergeFrom(
                         shadow_proto.oneof_decl[missing_field.oneof_index])
+                    extra_oneof_fields.append([])
                 missing_field.oneof_index = missing_oneof_index
                 extra_oneof_fields[missing_oneof_index].append(missing_field)
             else:
                 extra_simple_fields.append(missing_field)
         else:
             target_proto.reserved_name.append(n)
-    # Copy existing fields, as we need to nuke them.
-    existing_fields = copy.deepcopy(target_proto.field)
-    del target_proto.field[:]
     # Rebuild fields, taking into account extra_oneof_fields. protoprint.py
-    # expects that oneof fields are consecutive, so need to sort for this.
+    # expects that oneof fields are consecutive, so need to sort for this. The
+    # existing fields in target_proto are those from active_proto, so we build
+    # the new field list from the latter and swap it in once at the end.
+    new_fields = []
     current_oneof_index = None
+    # Only the locations under this message's fields can need adjusting, so
+    # gather them once rather than scanning all locations per oneof.
+    locations = field_locations(type_context) if any(extra_oneof_fields) else []
 
     def append_extra_oneof_fields(current_oneof_index, last_oneof_field_index):
         # Add fields from extra_oneof_fields for current_oneof_index.
-        for oneof_f in extra_oneof_fields[current_oneof_index]:
-            target_proto.field.add().MergeFrom(oneof_f)
+        new_fields.extend(extra_oneof_fields[current_oneof_index])
         field_adjustment = len(extra_oneof_fields[current_oneof_index])
-        # Fixup the comments in source code info. Note that this is really
-        # inefficient, O(N^2) in the worst case, but since we have relatively few
-        # deprecated fields, is the easiest to implement method.
+        # Fixup the comments in source code info.
         if last_oneof_field_index is not None:
-            adjust_source_code_info(type_context, last_oneof_field_index, field_adjustment)
-        del extra_oneof_fields[current_oneof_index]
+            adjust_source_code_info(
+                type_context, locations, last_oneof_field_index, field_adjustment)
+        extra_oneof_fields[current_oneof_index] = []
         return field_adjustment
 
     field_index = 0
-    for f in existing_fields:
-        if current_oneof_index is not None:
-            field_oneof_index = f.oneof_index if f.HasField('oneof_index') else None
-            # Are we exiting the oneof? If so, add the respective extra_one_fields.
-            if field_oneof_index != current_oneof_index:
-                field_index += append_extra_oneof_fields(current_oneof_index, field_index)
-                current_oneof_index = field_oneof_index
-        elif f.HasField('oneof_index'):
-            current_oneof_index = f.oneof_index
-        target_proto.field.add().MergeFrom(f)
+    for f in active_proto.field:
+        field_oneof_index = f.oneof_index if f.HasField('oneof_index') else None
+        if current_oneof_index is None:
+            current_oneof_index = field_oneof_index
+        # Are we exiting the oneof? If so, add the respective extra_one_fields.
+        elif field_oneof_index != current_oneof_index:
+            field_index += append_extra_oneof_fields(current_oneof_index, field_index)
+            current_oneof_index = field_oneof_index
+        new_fields.append(f)
         field_index += 1
     if current_oneof_index is not None:
         # No need to adjust source code info here, since there are no comments for
@@ -170,60 +218,59 @@ def merge_active_shadow_message(
     # Non-oneof fields are easy to treat, we just append them to the existing
     # fields. They don't get any comments, but that's fine in the generated
     # shadows.
-    for f in extra_simple_fields:
-        target_proto.field.add().MergeFrom(f)
-    for oneof_index in sorted(extra_oneof_fields.keys()):
-        for f in extra_oneof_fields[oneof_index]:
-            target_proto.field.add().MergeFrom(f)
+    new_fields.extend(extra_simple_fields)
     # Same is true for oneofs that are exclusively from the shadow.
+    for oneof_fields in extra_oneof_fields:
+        new_fields.extend(oneof_fields)
+    target_proto.ClearField('field')
+    target_proto.field.extend(new_fields)
     adjust_reserved_range(target_proto, active_proto.reserved_range, skip_reserved_numbers)
-    # Visit nested message types
+    # Visit nested message types, consuming their shadows as we go.
     del target_proto.nested_type[:]
-    shadow_msgs = {msg.name: msg for msg in shadow_proto.nested_type}
     for index, msg in enumerate(active_proto.nested_type):
         merge_active_shadow_message(
             type_context.extend_nested_message(index, msg.name, msg.options.deprecated), msg,
-            shadow_msgs.get(msg.name), target_proto.nested_type.add(), target_proto_dependencies)
+            shadow_msgs.pop(msg.name, None), target_proto.nested_type.add(),
+            target_proto_dependencies)
     # Visit nested enum types
     del target_proto.enum_type[:]
-    shadow_enums = {msg.name: msg for msg in shadow_proto.enum_type}
     for enum in active_proto.enum_type:
         merge_active_shadow_enum(
             enum, shadow_enums.get(enum.name), target_proto.enum_type.add(),
             target_proto_dependencies)
     # Ensure target has any deprecated sub-message types in case they are needed.
-    active_msg_names = set([msg.name for msg in active_proto.nested_type])
-    for msg in shadow_proto.nested_type:
-        if msg.name not in active_msg_names:
-            target_proto.nested_type.add().MergeFrom(msg)
+    # These are the shadow messages left unconsumed above.
+    for msg in shadow_msgs.values():
+        target_proto.nested_type.add().MergeFrom(msg)
 
 
 # Merge active/shadow FileDescriptorProtos, returning the resulting FileDescriptorProto.
 def merge_active_shadow_file(active_file_proto, shadow_file_proto):
-    target_file_proto = copy.deepcopy(active_file_proto)
+    target_file_proto = descriptor_pb2.FileDescriptorProto()
+    target_file_proto.CopyFrom(active_file_proto)
     source_code_info = api_type_context.SourceCodeInfo(
         target_file_proto.name, target_file_proto.source_code_info)
     package_type_context = api_type_context.TypeContext(source_code_info, target_file_proto.package)
-    # Visit message types
+    target_proto_dependencies = Dependencies(target_file_proto.dependency)
+    # Visit message types, consuming their shadows as we go.
     del target_file_proto.message_type[:]
     shadow_msgs = {msg.name: msg for msg in shadow_file_proto.message_type}
     for index, msg in enumerate(active_file_proto.message_type):
         merge_active_shadow_message(
             package_type_context.extend_message(index, msg.name, msg.options.deprecated), msg,
-            shadow_msgs.get(msg.name), target_file_proto.message_type.add(),
-            target_file_proto.dependency)
+            shadow_msgs.pop(msg.name, None), target_file_proto.message_type.add(),
+            target_proto_dependencies)
     # Visit enum types
     del target_file_proto.enum_type[:]
     shadow_enums = {msg.name: msg for msg in shadow_file_proto.enum_type}
     for enum in active_file_proto.enum_type:
         merge_active_shadow_enum(
             enum, shadow_enums.get(enum.name), target_file_proto.enum_type.add(),
-            target_file_proto.dependency)
+            target_proto_dependencies)
     # Ensure target has any deprecated message types in case they are needed.
-    active_msg_names = set([msg.name for msg in active_file_proto.message_type])
-    for msg in shadow_file_proto.message_type:
-        if msg.name not in active_msg_names:
-            target_file_proto.message_type.add().MergeFrom(msg)
+    # These are the shadow messages left unconsumed above.
+    for msg in shadow_msgs.values():
+        target_file_proto.message_type.add().MergeFrom(msg)
     return target_file_proto
 
 
@@ -232,8 +279,14 @@ if __name__ == '__main__':
 
     utils.load_protos(PROTO_PACKAGES)
 
+    # Inputs are protoxform's text format artifacts. Text format parsing is
+    # considerably slower than binary; if this becomes a bottleneck, the
+    # protoxform rule should emit binary descriptors instead.
     active_proto = descriptor_pb2.FileDescriptorProto()
     text_format.Merge(pathlib.Path(active_src).read_text(), active_proto)
     shadow_proto = descriptor_pb2.FileDescriptorProto()
     text_format.Merge(pathlib.Path(shadow_src).read_text(), shadow_proto)
-    pathlib.Path(dst).write_text(str(merge_active_shadow_file(active_proto, shadow_proto)))
+    # protoprint.py consumes text format, so stream it straight to the
+    # destination rather than building the whole string first.
+    with open(dst, 'w') as f:
+        text_format.PrintMessage(merge_active_shadow_file(active_proto, shadow_proto), f)
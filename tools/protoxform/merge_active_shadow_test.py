@@ -107,7 +107,8 @@ value {
         target_proto = descriptor_pb2.EnumDescriptorProto()
         target_proto_dependencies = []
         merge_active_shadow.merge_active_shadow_enum(
-            active_proto, shadow_proto, target_proto, target_proto_dependencies)
+            active_proto, shadow_proto, target_proto,
+            merge_active_shadow.Dependencies(target_proto_dependencies))
         target_pb_text = """
 value {
   name: "foo"
@@ -262,7 +263,7 @@ oneof_decl {
         target_proto_dependencies = []
         merge_active_shadow.merge_active_shadow_message(
             fake_type_context.extend_message(1, "foo", False), active_proto, shadow_proto,
-            target_proto, target_proto_dependencies)
+            target_proto, merge_active_shadow.Dependencies(target_proto_dependencies))
         target_pb_text = """
 field {
   name: "oneof_1_0"
@@ -469,7 +470,7 @@ oneof_decl {
         target_proto_dependencies = []
         merge_active_shadow.merge_active_shadow_message(
             self.fake_type_context(), active_proto, shadow_proto, target_proto,
-            target_proto_dependencies)
+            merge_active_shadow.Dependencies(target_proto_dependencies))
         target_pb_text = """
 field {
   name: "foo"
@@ -519,6 +520,23 @@ reserved_range {
         self.assert_text_proto_eq(target_pb_text, str(target_proto))
         self.assertEqual(target_proto_dependencies[0], 'envoy/annotations/deprecation.proto')
 
+    def testmerge_active_shadow_message_nested(self):
+        """merge_active_shadow_message recovers shadow fields in nested messages."""
+        active_proto = descriptor_pb2.DescriptorProto()
+        active_proto.field.add(name='foo', number=1)
+        active_proto.nested_type.add(name='bar', reserved_name=['wow'])
+        shadow_proto = descriptor_pb2.DescriptorProto()
+        shadow_proto.field.add(name='foo', number=1)
+        shadow_proto.nested_type.add(name='bar').field.add(
+            name='hidden_envoy_deprecated_wow', number=2)
+        target_proto = descriptor_pb2.DescriptorProto()
+        merge_active_shadow.merge_active_shadow_message(
+            self.fake_type_context(), active_proto, shadow_proto, target_proto,
+            merge_active_shadow.Dependencies([]))
+        self.assertEqual(target_proto.field[0].name, 'foo')
+        self.assertEqual(target_proto.nested_type[0].field[0].name, 'hidden_envoy_deprecated_wow')
+        self.assertEqual(len(target_proto.nested_type[0].reserved_name), 0)
+
     def testmerge_active_shadow_message_no_shadow_message(self):
         """merge_active_shadow_message doesn't require a shadow message for new nested active messages."""
         active_proto = descriptor_pb2.DescriptorProto()
@@ -528,7 +546,7 @@ reserved_range {
         target_proto_dependencies = []
         merge_active_shadow.merge_active_shadow_message(
             self.fake_type_context(), active_proto, shadow_proto, target_proto,
-            target_proto_dependencies)
+            merge_active_shadow.Dependencies(target_proto_dependencies))
         self.assertEqual(target_proto.nested_type[0].name, 'foo')
 
     def testmerge_active_shadow_message_no_shadow_enum(self):
@@ -540,7 +558,7 @@ reserved_range {
         target_proto_dependencies = []
         merge_active_shadow.merge_active_shadow_message(
             self.fake_type_context(), active_proto, shadow_proto, target_proto,
-            target_proto_dependencies)
+            merge_active_shadow.Dependencies(target_proto_dependencies))
         self.assertEqual(target_proto.enum_type[0].name, 'foo')
 
     def testmerge_active_shadow_message_missing(self):
@@ -552,7 +570,7 @@ reserved_range {
         target_proto_dependencies = []
         merge_active_shadow.merge_active_shadow_message(
             self.fake_type_context(), active_proto, shadow_proto, target_proto,
-            target_proto_dependencies)
+            merge_active_shadow.Dependencies(target_proto_dependencies))
         self.assertEqual(target_proto.nested_type[0].name, 'foo')
 
     def testmerge_active_shadow_file_missing(self):